@@ -0,0 +1,23 @@
+# _compile_kernels.py
+# ----------------------------------------------------------
+# stripe_kernels.py のカーネルを事前コンパイル (AOT) して、
+# 拡張モジュール _stripe_kernels を生成するスクリプトです。
+#
+#   python _compile_kernels.py
+#
+# 生成物があれば stripe_app.py は起動直後からそれを使い、
+# 無ければ従来どおり初回呼び出し時に JIT コンパイルします。
+# ----------------------------------------------------------
+
+import os
+from numba.pycc import CC
+import stripe_kernels
+
+cc = CC("_stripe_kernels")
+cc.output_dir = os.path.dirname(os.path.abspath(__file__))
+
+cc.export("emit_segments", "UniTuple(i4[:], 3)(u1[:, :], u1[:], i8, i8)")(stripe_kernels.emit_segments)
+cc.export("format_path", "u1[:](i8[:, :])")(stripe_kernels.format_path)
+
+if __name__ == "__main__":
+    cc.compile()
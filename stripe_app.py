@@ -9,103 +9,211 @@
 # License: MIT
 # ----------------------------------------------------------
 
-from PIL import Image, ExifTags, ImageOps
+from PIL import Image, ImageOps
 from io import BytesIO
 import numpy as np
-import xml.etree.ElementTree as ET
-from xml.dom import minidom
+import cv2
 import streamlit as st
 import streamlit.components.v1 as components
 import os
+import hashlib
 
+try:
+    import numba
+except ImportError:
+    numba = None
+
+CV_BLOCK_MEAN_MIN_BYTES = 1 << 20
+
+def hash_ndarray(arr):
+    # Streamlit は大きな配列を一部の要素の標本からしかハッシュしないため、
+    # 数画素だけ違う画像でも別の画像のキャッシュが返らないよう全体から計算する
+    arr = np.ascontiguousarray(arr)
+    return arr.shape, arr.dtype.str, hashlib.md5(arr.data).digest()
+
+CACHE_OPTIONS = dict(show_spinner=False, ttl=3600, hash_funcs={np.ndarray: hash_ndarray})
+
+@st.cache_data(max_entries=4, **CACHE_OPTIONS)
 def read_image_from_bytes(file_bytes):
     image = Image.open(BytesIO(file_bytes))
-    try:
-        exif = image._getexif()
-        if exif:
-            orientation_key = next(k for k, v in ExifTags.TAGS.items() if v == 'Orientation')
-            if orientation_key in exif:
-                image = ImageOps.exif_transpose(image)
-    except Exception:
-        pass
-    return np.array(image.convert("L"))
+    # 向き情報の EXIF を持つのは JPEG 系だけなので、それ以外は調べない
+    if image.format in ("JPEG", "MPO"):
+        try:
+            image = ImageOps.exif_transpose(image)
+        except Exception:
+            pass
+    return np.asarray(image.convert("L"))
 
+@st.cache_data(max_entries=8, **CACHE_OPTIONS)
 def resize_image(img_array, new_size):
-    image = Image.fromarray(img_array)
-    resized = image.resize(new_size, Image.Resampling.BOX)
-    return np.array(resized)
+    return cv2.resize(img_array, new_size, interpolation=cv2.INTER_AREA)
 
 def apply_tone_adjustments(img_array, gamma=1.0):
     adjusted = np.power(img_array / 255.0, gamma) * 255
     return np.clip(adjusted, 0, 255).astype(np.uint8)
 
-def build_svg_tree(img, w, h, direction, block_size=12, max_lines=5,
-                   line_spacing=1, merge_threshold=1,
-                   use_absolute_size=False, contrast_strength=1.0):
+def density_lut(max_lines, contrast_strength):
+    # 平均輝度 (0-255) ごとの線の本数を先に表にしておき、ブロックごとの浮動小数点演算を省く
+    levels = np.arange(256)
+    lut = (((255 - levels) / 255 * contrast_strength) * max_lines).astype(int)
+    return np.clip(lut, 0, max_lines).astype(np.uint8)
+
+def block_means(img, block_size):
+    h, w = img.shape[:2]
+    if img.nbytes >= CV_BLOCK_MEAN_MIN_BYTES:
+        return integral_block_means(img, block_size)
+
+    nby, nbx = -(-h // block_size), -(-w // block_size)
+    fy, fx = h // block_size, w // block_size
+    hc, wc = fy * block_size, fx * block_size
+
+    # 割り切れる部分は一括で合計し、右端・下端の端数ブロックだけ別に計算する
+    means = np.empty((nby, nbx), dtype=np.uint8)
+    tiles = img[:hc, :wc].reshape(fy, block_size, fx, block_size)
+    means[:fy, :fx] = tiles.sum(axis=(1, 3), dtype=np.uint32) // (block_size * block_size)
+    if wc < w:
+        strip = img[:hc, wc:].reshape(fy, block_size, w - wc)
+        means[:fy, fx] = strip.sum(axis=(1, 2), dtype=np.uint32) // (block_size * (w - wc))
+    if hc < h:
+        strip = img[hc:, :wc].reshape(h - hc, fx, block_size)
+        means[fy, :fx] = strip.sum(axis=(0, 2), dtype=np.uint32) // ((h - hc) * block_size)
+    if hc < h and wc < w:
+        corner = img[hc:, wc:]
+        means[fy, fx] = corner.sum(dtype=np.uint32) // corner.size
+    return means
+
+def integral_block_means(img, block_size):
+    # 大きな画像は OpenCV の SIMD 実装で積分画像を作り、ブロックの四隅の差から合計を求める。
+    # 合計は正確なので、平均の切り捨ては小さな画像や Numba の経路と一致する
+    h, w = img.shape[:2]
+    ys = np.append(np.arange(0, h, block_size), h)
+    xs = np.append(np.arange(0, w, block_size), w)
+    integral = cv2.integral(np.ascontiguousarray(img), sdepth=cv2.CV_32S)
+
+    # int32 の積分画像は巨大な画像で桁あふれするが、uint32 の剰余演算で差を取れば
+    # 2**32 未満のブロック合計は正しく求まる
+    corners = integral[np.ix_(ys, xs)].astype(np.uint32)
+    sums = corners[1:, 1:] - corners[:-1, 1:] - corners[1:, :-1] + corners[:-1, :-1]
+    counts = np.diff(ys)[:, None] * np.diff(xs)[None, :]
+    return (sums // counts).astype(np.uint8)
+
+def build_segment_mask(densities, direction, block_size, line_spacing):
+    # 垂直方向は行列を転置して水平方向と同じ処理に帰着させる
+    lanes = densities if direction == "水平" else densities.T
+    n_lanes, n_cols = lanes.shape
+
+    # 走査線 × ブロック列の真偽値マスクで、各走査線に線を引くブロックを表す。
+    # 線番号ごとの比較は一度のブロードキャストでまとめて行う
+    present = np.zeros((n_lanes, block_size, n_cols), dtype=bool)
+    line_idx = np.arange(int(lanes.max(initial=0)))
+    present[:, line_idx * line_spacing, :] = lanes[:, None, :] > line_idx[None, :, None]
+    return present.reshape(n_lanes * block_size, n_cols)
+
+def mask_runs(present, block_size):
+    # 各行の True の連続区間を両端の差分から求める (ランレングス符号化)
+    padded = np.zeros((present.shape[0], present.shape[1] + 2), dtype=np.int8)
+    padded[:, 1:-1] = present
+    edges = np.diff(padded, axis=1)
+    keys, run_starts = np.nonzero(edges == 1)
+    _, run_ends = np.nonzero(edges == -1)
+    return keys, run_starts * block_size, run_ends * block_size
+
+def merge_segments(keys, starts, ends, merge_threshold):
+    if len(keys) == 0:
+        return keys, starts, ends
+
+    # キーごとにずらして一列に並べ、累積最大値がキーをまたがないようにする
+    span = int(ends.max()) + merge_threshold + 1
+    offset = keys * span
+    reach = np.maximum.accumulate(ends + offset)
 
-    svg_attrib = {
-        "xmlns": "http://www.w3.org/2000/svg",
-        "version": "1.1"
-    }
+    new_run = np.empty(len(keys), dtype=bool)
+    new_run[0] = True
+    new_run[1:] = (keys[1:] != keys[:-1]) | (starts[1:] + offset[1:] > reach[:-1] + merge_threshold)
+    run_starts = np.flatnonzero(new_run)
 
+    return keys[run_starts], starts[run_starts], np.maximum.reduceat(ends, run_starts)
+
+@st.cache_resource(show_spinner=False)
+def load_kernels():
+    # 事前コンパイル済みの拡張モジュールがあれば、JIT のコンパイル待ちなしで使える
+    try:
+        import _stripe_kernels
+        return _stripe_kernels.emit_segments, _stripe_kernels.format_path
+    except ImportError:
+        pass
+    if numba is None:
+        return None, None
+
+    # スクリプトの再実行ごとに再コンパイルされないよう、最初のディスパッチャを使い回す
+    import stripe_kernels
+    return (numba.njit(parallel=True, cache=True)(stripe_kernels.emit_segments),
+            numba.njit(parallel=True, cache=True)(stripe_kernels.format_path))
+
+@st.cache_data(max_entries=16, **CACHE_OPTIONS)
+def compute_segments(img, direction, block_size, max_lines, line_spacing,
+                     merge_threshold, contrast_strength):
+    lut = density_lut(max_lines, contrast_strength)
+    if lut[0] == 0:
+        # 真っ黒なブロックでも線が引かれない設定なら、画像を読むまでもなく空になる
+        empty = np.empty(0, dtype=np.int32)
+        return empty, empty, empty
+
+    kernel, _ = load_kernels()
+    if kernel is not None:
+        lanes_img = img if direction == "水平" else img.T
+        keys, starts, ends = kernel(np.ascontiguousarray(lanes_img), lut, block_size, line_spacing)
+    else:
+        # 1ブロックに収まる線の本数を超える分は描画されない
+        lines_per_block = -(-block_size // line_spacing)
+        densities = np.minimum(lut[block_means(img, block_size)], lines_per_block)
+        present = build_segment_mask(densities, direction, block_size, line_spacing)
+        if 0 <= merge_threshold < block_size:
+            # 幅の揃ったブロック格子では隣り合うブロック同士しかつながらないので、
+            # 連続区間がそのまま結合後のセグメントになる
+            return mask_runs(present, block_size)
+
+        # np.nonzero は行優先で返すので (キー, 開始位置) の順に並んだ状態になる
+        keys, cols = np.nonzero(present)
+        starts = cols * block_size
+        ends = starts + block_size
+    return merge_segments(keys, starts, ends, merge_threshold)
+
+def format_path_data(keys, starts, ends, direction):
+    if direction == "水平":
+        coords = np.column_stack((starts, keys, ends, keys))
+    else:
+        coords = np.column_stack((keys, starts, keys, ends))
+
+    _, kernel = load_kernels()
+    if kernel is not None:
+        return kernel(np.ascontiguousarray(coords, dtype=np.int64)).tobytes()
+
+    # セグメントごとの f-string をやめ、bytes の % 書式化 1 回でまとめて整形する
+    return (b"M%d %dL%d %d" * len(coords)) % tuple(coords.ravel().tolist())
+
+def build_svg_body(img, w, h, direction, block_size=12, max_lines=5,
+                   line_spacing=1, merge_threshold=1, contrast_strength=1.0):
+    keys, starts, ends = compute_segments(img[:h, :w], direction, block_size, max_lines,
+                                          line_spacing, merge_threshold, contrast_strength)
+    path_data = format_path_data(keys, starts, ends, direction)
+    if not path_data:
+        return b""
+
+    # str に戻さずバイト列のまま組み立て、そのままダウンロードボタンに渡す
+    return b'<path d="' + path_data + b'" stroke="black" stroke-width="0.5" fill="none"/>\n'
+
+def wrap_svg(body, w, h, use_absolute_size=False):
+    # 表示用とダウンロード用は <svg> タグの属性だけが異なるので、本体は使い回す
     if use_absolute_size:
-        svg_attrib["width"] = f"{w}px"
-        svg_attrib["height"] = f"{h}px"
+        size_attrs = f'width="{w}px" height="{h}px"'
     else:
-        svg_attrib["width"] = "100%"
-        svg_attrib["height"] = "auto"
-        svg_attrib["viewBox"] = f"0 0 {w} {h}"
-        svg_attrib["preserveAspectRatio"] = "xMidYMid meet"
-
-    svg = ET.Element("svg", svg_attrib)
-    line_buffer = {}
-
-    for by in range(0, h, block_size):
-        for bx in range(0, w, block_size):
-            block = img[by:by + block_size, bx:bx + block_size]
-            if block.size == 0:
-                continue
-            avg = np.mean(block)
-            density = int(((255 - avg) / 255 * contrast_strength) * max_lines)
-            density = np.clip(density, 0, max_lines)
-
-            for i in range(density):
-                if direction == "水平":
-                    y = by + i * line_spacing
-                    if y >= by + block_size:
-                        break
-                    line_buffer.setdefault(y, []).append((bx, bx + block_size))
-                elif direction == "垂直":
-                    x = bx + i * line_spacing
-                    if x >= bx + block_size:
-                        break
-                    line_buffer.setdefault(x, []).append((by, by + block_size))
-
-    def merge_segments(segments):
-        merged = []
-        for x1, x2 in sorted(segments):
-            if not merged or x1 > merged[-1][1] + merge_threshold:
-                merged.append([x1, x2])
-            else:
-                merged[-1][1] = max(merged[-1][1], x2)
-        return merged
-
-    path_data = []
-    for key in sorted(line_buffer.keys()):
-        for x1, x2 in merge_segments(line_buffer[key]):
-            if direction == "水平":
-                path_data.append(f"M {x1} {key} L {x2} {key}")
-            elif direction == "垂直":
-                path_data.append(f"M {key} {x1} L {key} {x2}")
-    if path_data:
-        ET.SubElement(svg, "path", {
-            "d": " ".join(path_data),
-            "stroke": "black",
-            "stroke-width": "0.5",
-            "fill": "none"
-        })
-
-    return minidom.parseString(ET.tostring(svg, 'utf-8')).toprettyxml(indent="  ")
+        size_attrs = (f'width="100%" height="auto" viewBox="0 0 {w} {h}" '
+                      'preserveAspectRatio="xMidYMid meet"')
+
+    header = (b'<?xml version="1.0" ?>\n'
+              + f'<svg xmlns="http://www.w3.org/2000/svg" version="1.1" {size_attrs}>\n'.encode("ascii"))
+    return b"".join((header, body, b"</svg>"))
 
 # Streamlit UI
 st.set_page_config(page_title="Linear Halftone SVG Generator", layout="wide")
@@ -151,19 +259,17 @@ if uploaded_file:
 
     adjusted_img = apply_tone_adjustments(resized, gamma=gamma_value)
 
-    svg_for_display = build_svg_tree(adjusted_img, new_w, new_h, direction,
-                                     use_absolute_size=False,
-                                     contrast_strength=contrast_strength)
+    svg_body = build_svg_body(adjusted_img, new_w, new_h, direction,
+                              contrast_strength=contrast_strength)
 
-    svg_for_download = build_svg_tree(adjusted_img, new_w, new_h, direction,
-                                      use_absolute_size=True,
-                                      contrast_strength=contrast_strength)
+    svg_for_display = wrap_svg(svg_body, new_w, new_h, use_absolute_size=False)
+    svg_for_download = wrap_svg(svg_body, new_w, new_h, use_absolute_size=True)
 
     st.subheader("プレビュー")
     svg_html = f"""
     <div style="text-align:left; background:white; margin-top:16px; margin-bottom:24px;">
       <div style="display:inline-block; max-width:100%; height:auto;">
-        {svg_for_display}
+        {svg_for_display.decode("utf-8")}
       </div>
     </div>
     """
@@ -176,5 +282,5 @@ if uploaded_file:
     base_name = os.path.splitext(uploaded_file.name)[0]
     output_file_name = f"{base_name}_stripe.svg"
 
-    st.download_button("SVGをダウンロード", svg_for_download.encode("utf-8"),
+    st.download_button("SVGをダウンロード", svg_for_download,
                        file_name=output_file_name, mime="image/svg+xml")
\ No newline at end of file
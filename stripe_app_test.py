@@ -0,0 +1,124 @@
+import unittest
+from unittest import mock
+
+import numpy as np
+
+import stripe_app
+
+try:
+    import numba
+    import stripe_kernels
+except ImportError:
+    numba = None
+
+try:
+    import _stripe_kernels
+except ImportError:
+    _stripe_kernels = None
+
+compute_segments = stripe_app.compute_segments.__wrapped__
+
+CASES = [
+    # (高さ, 幅, ブロック, 最大本数, 線間隔, 結合しきい値, コントラスト)
+    (60, 48, 12, 5, 1, 1, 1.0),
+    (61, 53, 12, 5, 1, 1, 1.0),
+    (37, 29, 7, 3, 2, 0, 1.7),
+    (45, 50, 12, 5, 3, 12, 1.0),
+    (45, 50, 5, 4, 1, 30, 0.5),
+    (19, 23, 1, 2, 1, 1, 3.0),
+    (33, 41, 16, 7, 4, 1, 1.0),
+    (30, 30, 12, 5, 1, 1, 0.1),
+]
+
+def reference_segments(img, direction, block_size, max_lines, line_spacing,
+                       merge_threshold, contrast_strength):
+    h, w = img.shape
+    line_buffer = {}
+    for by in range(0, h, block_size):
+        for bx in range(0, w, block_size):
+            block = img[by:by + block_size, bx:bx + block_size]
+            avg = int(block.sum()) // block.size
+            density = int(((255 - avg) / 255 * contrast_strength) * max_lines)
+            density = min(max(density, 0), max_lines)
+            for i in range(density):
+                if i * line_spacing >= block_size:
+                    break
+                if direction == "水平":
+                    line_buffer.setdefault(by + i * line_spacing, []).append((bx, bx + block_size))
+                else:
+                    line_buffer.setdefault(bx + i * line_spacing, []).append((by, by + block_size))
+
+    segments = []
+    for key in sorted(line_buffer):
+        merged = []
+        for x1, x2 in sorted(line_buffer[key]):
+            if not merged or x1 > merged[-1][1] + merge_threshold:
+                merged.append([x1, x2])
+            else:
+                merged[-1][1] = max(merged[-1][1], x2)
+        segments.extend((key, x1, x2) for x1, x2 in merged)
+    return segments
+
+def make_image(rng, h, w):
+    img = rng.integers(0, 256, (h, w), dtype=np.uint8)
+    img[: h // 3] = 255
+    img[h // 3: h // 2, : w // 2] = 0
+    return img
+
+class ComputeSegmentsTest(unittest.TestCase):
+    kernels = (None, None)
+
+    def assert_matches_reference(self):
+        rng = np.random.default_rng(0)
+        with mock.patch.object(stripe_app, "load_kernels", return_value=self.kernels):
+            for case in CASES:
+                h, w, *params = case
+                img = make_image(rng, h, w)
+                for direction in ["水平", "垂直"]:
+                    with self.subTest(case=case, direction=direction):
+                        keys, starts, ends = compute_segments(img, direction, *params)
+                        actual = list(zip(keys.tolist(), starts.tolist(), ends.tolist()))
+                        self.assertEqual(actual, reference_segments(img, direction, *params))
+
+    def test_matches_reference(self):
+        self.assert_matches_reference()
+
+class IntegralBlockMeansTest(ComputeSegmentsTest):
+    def test_matches_reference(self):
+        with mock.patch.object(stripe_app, "CV_BLOCK_MEAN_MIN_BYTES", 0):
+            self.assert_matches_reference()
+
+@unittest.skipIf(numba is None, "numba is not installed")
+class JitKernelTest(ComputeSegmentsTest):
+    @classmethod
+    def setUpClass(cls):
+        cls.kernels = (numba.njit(parallel=True)(stripe_kernels.emit_segments),
+                       numba.njit(parallel=True)(stripe_kernels.format_path))
+
+@unittest.skipIf(_stripe_kernels is None, "_stripe_kernels has not been compiled")
+class AotKernelTest(ComputeSegmentsTest):
+    @classmethod
+    def setUpClass(cls):
+        cls.kernels = (_stripe_kernels.emit_segments, _stripe_kernels.format_path)
+
+class FormatPathDataTest(unittest.TestCase):
+    def test_kernel_matches_bytes_format(self):
+        keys = np.array([0, 3, 3, 120], dtype=np.int32)
+        starts = np.array([0, 12, 48, 1000], dtype=np.int32)
+        ends = starts + 12
+        with mock.patch.object(stripe_app, "load_kernels", return_value=(None, None)):
+            expected = stripe_app.format_path_data(keys, starts, ends, "水平")
+        self.assertEqual(expected, b"M0 0L12 0M12 3L24 3M48 3L60 3M1000 120L1012 120")
+
+        if numba is None:
+            self.skipTest("numba is not installed")
+        kernels = (None, numba.njit(parallel=True)(stripe_kernels.format_path))
+        with mock.patch.object(stripe_app, "load_kernels", return_value=kernels):
+            for direction in ["水平", "垂直"]:
+                with self.subTest(direction=direction):
+                    actual = stripe_app.format_path_data(keys, starts, ends, direction)
+                    with mock.patch.object(stripe_app, "load_kernels", return_value=(None, None)):
+                        self.assertEqual(actual, stripe_app.format_path_data(keys, starts, ends, direction))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,100 @@
+# stripe_kernels.py
+# ----------------------------------------------------------
+# stripe_app.py の重いループ部分を Numba 向けに書いたカーネル群です。
+# 実行時に JIT コンパイルされるほか、_compile_kernels.py で
+# 事前コンパイル (AOT) 済みの拡張モジュールとしても利用できます。
+# ----------------------------------------------------------
+
+import numpy as np
+from numba import njit, prange
+
+def emit_segments(img, lut, block_size, line_spacing):
+    h, w = img.shape
+    nby = (h + block_size - 1) // block_size
+    nbx = (w + block_size - 1) // block_size
+    lines_per_block = min(lut[0], (block_size + line_spacing - 1) // line_spacing)
+    row_cap = nbx * lines_per_block
+
+    keys = np.empty(nby * row_cap, dtype=np.int32)
+    starts = np.empty(nby * row_cap, dtype=np.int32)
+    counts = np.zeros(nby, dtype=np.int64)
+    densities = np.empty((nby, nbx), dtype=np.int64)
+
+    for byi in prange(nby):
+        by = byi * block_size
+        y_end = min(by + block_size, h)
+        row_lines = 0
+        for bxi in range(nbx):
+            bx = bxi * block_size
+            x_end = min(bx + block_size, w)
+            s = 0
+            for y in range(by, y_end):
+                for x in range(bx, x_end):
+                    s += img[y, x]
+            avg = s // ((y_end - by) * (x_end - bx))
+            density = min(lut[avg], lines_per_block)
+            densities[byi, bxi] = density
+            row_lines = max(row_lines, density)
+
+        # 余白などで線の無い行は書き出しを丸ごと飛ばす。
+        # 行内は (キー, 開始位置) の昇順で書き出されるので後段のソートは不要
+        base = byi * row_cap
+        n = 0
+        for i in range(row_lines):
+            for bxi in range(nbx):
+                if densities[byi, bxi] > i:
+                    keys[base + n] = by + i * line_spacing
+                    starts[base + n] = bxi * block_size
+                    n += 1
+        counts[byi] = n
+
+    offsets = np.zeros(nby + 1, dtype=np.int64)
+    for byi in range(nby):
+        offsets[byi + 1] = offsets[byi] + counts[byi]
+    out_keys = np.empty(offsets[nby], dtype=np.int32)
+    out_starts = np.empty(offsets[nby], dtype=np.int32)
+    for byi in prange(nby):
+        n = counts[byi]
+        out_keys[offsets[byi]:offsets[byi] + n] = keys[byi * row_cap:byi * row_cap + n]
+        out_starts[offsets[byi]:offsets[byi] + n] = starts[byi * row_cap:byi * row_cap + n]
+    return out_keys, out_starts, (out_starts + block_size).astype(np.int32)
+
+@njit(cache=True)
+def _count_digits(value):
+    n = 1
+    while value >= 10:
+        value //= 10
+        n += 1
+    return n
+
+@njit(cache=True)
+def _write_int(out, pos, value):
+    n = _count_digits(value)
+    for k in range(n - 1, -1, -1):
+        out[pos + k] = 48 + value % 10
+        value //= 10
+    return pos + n
+
+def format_path(coords):
+    # 各セグメントの文字数を数えて書き込み位置を決めておけば、セグメントごとに並列に書ける
+    n = coords.shape[0]
+    offsets = np.zeros(n + 1, dtype=np.int64)
+    for k in prange(n):
+        size = 4
+        for j in range(4):
+            size += _count_digits(coords[k, j])
+        offsets[k + 1] = size
+    offsets = np.cumsum(offsets)
+
+    out = np.empty(offsets[n], dtype=np.uint8)
+    for k in prange(n):
+        pos = offsets[k]
+        out[pos] = 77  # "M"
+        pos = _write_int(out, pos + 1, coords[k, 0])
+        out[pos] = 32  # " "
+        pos = _write_int(out, pos + 1, coords[k, 1])
+        out[pos] = 76  # "L"
+        pos = _write_int(out, pos + 1, coords[k, 2])
+        out[pos] = 32  # " "
+        _write_int(out, pos + 1, coords[k, 3])
+    return out